@@ -1,71 +1,206 @@
 import os
+import re
+import argparse
+import json
 import sqlite3
 from pathlib import Path
 from dataclasses import dataclass
-from typing import List, Optional
-from datetime import datetime
+from typing import Iterator, List, Optional
 
-@dataclass
+# Container directory names that may hold Books databases
+_CONTAINER_RE = re.compile(r"book|bk|annotation", re.IGNORECASE)
+
+# Known (table, asset ID column) layouts of the library database, most recent first
+_TITLE_SOURCES = [
+    ("ZBKLIBRARYASSET", "ZASSETID"),
+    ("ZBKLIBRARYASSET", "ZBKASSETID"),
+    ("ZBKLIBRARY", "ZASSETID"),
+]
+
+# Annotation columns read by the highlights query
+_ANNOTATION_COLUMNS = {
+    "ZANNOTATIONSELECTEDTEXT", "ZANNOTATIONCREATIONDATE", "ZANNOTATIONNOTE", "ZANNOTATIONASSETID",
+    "ZANNOTATIONREPRESENTATIVETEXT", "ZANNOTATIONTYPE", "ZANNOTATIONISUNDERLINE", "ZANNOTATIONDELETED",
+}
+
+# Library columns needed to describe books that have no highlights
+_BOOK_INFO_COLUMNS = {"ZTITLE", "ZAUTHOR", "ZREADINGPROGRESS", "ZLASTOPENDATE", "ZBOOKDESCRIPTION", "ZGENRE"}
+
+# Read-side tuning applied to every schema we open; journal and sync settings
+# are left alone because Apple Books owns these files and we never write to them
+_READ_PRAGMAS = [
+    "temp_store = MEMORY",
+    "cache_size = -64000",
+    "mmap_size = 268435456",
+]
+
+# Format of the dates written to the export, applied by SQLite's strftime()
+_DATE_FMT = "%Y-%m-%d %H:%M:%S"
+
+# Number of formatted lines collected before they are written out during export
+_MAX_BUFFERED_LINES = 5000
+
+def _casefold(value):
+    """SQL casefold() for title matching and ordering; non-text values pass through unchanged"""
+    return value.casefold() if isinstance(value, str) else value
+
+class _FilenameTable(dict):
+    """str.translate table that keeps alphanumerics, spaces, '-' and '_', filled in lazily"""
+    def __missing__(self, codepoint: int) -> Optional[int]:
+        char = chr(codepoint)
+        value = codepoint if char.isalnum() or char in (' ', '-', '_') else None
+        self[codepoint] = value
+        return value
+
+_FILENAME_TABLE = _FilenameTable()
+
+@dataclass(slots=True)
 class Highlight:
     text: str
-    created_at: datetime
+    created_at: str
     book_title: str
     chapter: Optional[str] = None
     note: Optional[str] = None
 
 class BookHighlightExtractor:
-    def __init__(self):
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
         self.annotation_db_path, self.library_db_path = self._get_database_path()
         self.annotation_conn = None
         self.library_conn = None
+        self._title_source = None
+        self._title_query = None
+        self._has_annotations = False
+        self._has_book_info = False
+        self._title_memo: dict[str, Optional[str]] = {}
 
     def _get_database_path(self) -> tuple[Path, Optional[Path]]:
         """Get the path to Apple Books database and library database"""
         home = Path.home()
         containers_path = home / "Library/Containers"
+        cache_path = home / ".cache/book-highlight-extractor/paths.json"
+        
+        try:
+            containers_mtime = os.stat(containers_path).st_mtime_ns
+        except OSError:
+            containers_mtime = None
+        
+        cached = self._load_cached_paths(cache_path, containers_mtime)
+        if cached:
+            self._log(f"\nUsing cached database paths from {cache_path}")
+            return cached
+        
+        annotation_db, library_db = self._search_database_paths(containers_path)
         
-        # Updated search patterns for database files
-        annotation_patterns = [
-            "**/BKAnnotation/*.sqlite",
-            "**/AEAnnotation/*.sqlite",
+        if annotation_db and library_db and containers_mtime is not None:
+            self._save_cached_paths(cache_path, containers_mtime, annotation_db, library_db)
+        
+        if not annotation_db:
+            # Default annotation database path
+            annotation_db = home / "Library/Containers/com.apple.iBooksX/Data/Documents/AEAnnotation/annotations.sqlite"
+            self._log(f"\nNo annotation database found. Will use default path: {annotation_db}")
+        
+        return annotation_db, library_db
+
+    def _log(self, *args):
+        """Print diagnostic output only when running verbosely"""
+        if self.verbose:
+            print(*args)
+
+    def _load_cached_paths(self, cache_path: Path, containers_mtime: Optional[int]) -> Optional[tuple[Path, Path]]:
+        """Return cached database paths if the containers directory is unchanged"""
+        if containers_mtime is None:
+            return None
+        
+        try:
+            with open(cache_path, encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache["mtime"] != containers_mtime:
+                return None
+            annotation_db = Path(cache["annotation_db"])
+            library_db = Path(cache["library_db"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        
+        if annotation_db.exists() and library_db.exists():
+            return annotation_db, library_db
+        return None
+
+    def _save_cached_paths(self, cache_path: Path, containers_mtime: int, annotation_db: Path, library_db: Path):
+        """Remember discovered database paths for the next run"""
+        cache = {
+            "mtime": containers_mtime,
+            "annotation_db": str(annotation_db),
+            "library_db": str(library_db),
+        }
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+        except OSError as e:
+            self._log(f"Could not write path cache: {e}")
+
+    def _search_database_paths(self, containers_path: Path) -> tuple[Optional[Path], Optional[Path]]:
+        """Search Books containers for the annotation and library databases"""
+        # Known database directories relative to a Books container
+        annotation_subpaths = [
+            "Data/Documents/BKAnnotation",
+            "Data/Documents/AEAnnotation",
         ]
         
-        library_patterns = [
-            "**/com.apple.iBooksX/Data/Documents/BKLibrary/*.sqlite",
-            "**/com.apple.iBooks/Data/Documents/BKLibrary/*.sqlite",
-            "**/BKLibrary/*.sqlite",
+        library_subpaths = [
+            "Data/Documents/BKLibrary",
         ]
         
-        print("\nSearching for database files...")
+        self._log("\nSearching for database files...")
         
-        # Search in all containers related to Books
-        book_containers = [
-            d for d in containers_path.glob("*") 
-            if d.is_dir() and any(x in d.name.lower() for x in ["book", "bk", "annotation"])
-        ]
+        # Search in all containers related to Books; DirEntry caches the
+        # entry type from the directory listing, so is_dir() needs no extra stat
+        try:
+            with os.scandir(containers_path) as entries:
+                book_containers = [
+                    Path(entry.path) for entry in entries
+                    if _CONTAINER_RE.search(entry.name) and entry.is_dir()
+                ]
+        except OSError as e:
+            self._log(f"Could not list {containers_path}: {e}")
+            book_containers = []
         
         annotation_db = None
         library_db = None
         
         for container in book_containers:
-            print(f"\nChecking container: {container.name}")
+            self._log(f"\nChecking container: {container.name}")
             
             # Look for annotation database
-            for pattern in annotation_patterns:
-                for db_path in container.glob(pattern):
-                    print(f"Found annotation database: {db_path}")
-                    annotation_db = db_path
+            for subpath in annotation_subpaths:
+                candidate = container / subpath
+                if candidate.is_dir():
+                    for db_path in candidate.glob("*.sqlite"):
+                        self._log(f"Found annotation database: {db_path}")
+                        annotation_db = db_path
             
             # Look for library database
-            for pattern in library_patterns:
-                for db_path in container.glob(pattern):
-                    print(f"Found library database: {db_path}")
-                    library_db = db_path
+            for subpath in library_subpaths:
+                candidate = container / subpath
+                if candidate.is_dir():
+                    for db_path in candidate.glob("*.sqlite"):
+                        self._log(f"Found library database: {db_path}")
+                        library_db = db_path
         
-        if not annotation_db:
-            # Default annotation database path
-            annotation_db = home / "Library/Containers/com.apple.iBooksX/Data/Documents/AEAnnotation/annotations.sqlite"
-            print(f"\nNo annotation database found. Will use default path: {annotation_db}")
+        # Fall back to a single recursive walk per container for unusual layouts
+        if not annotation_db or not library_db:
+            annotation_dirs = {Path(subpath).name for subpath in annotation_subpaths} if not annotation_db else set()
+            library_dirs = {Path(subpath).name for subpath in library_subpaths} if not library_db else set()
+            
+            for container in book_containers:
+                for db_path in container.rglob("*.sqlite"):
+                    if db_path.parent.name in annotation_dirs:
+                        self._log(f"Found annotation database: {db_path}")
+                        annotation_db = db_path
+                    elif db_path.parent.name in library_dirs:
+                        self._log(f"Found library database: {db_path}")
+                        library_db = db_path
         
         return annotation_db, library_db
 
@@ -73,161 +208,292 @@ class BookHighlightExtractor:
         """Connect to the SQLite databases"""
         if not self.annotation_db_path.exists():
             raise FileNotFoundError(f"Annotation database not found at {self.annotation_db_path}")
-        self.annotation_conn = sqlite3.connect(self.annotation_db_path)
-        self.annotation_conn.row_factory = sqlite3.Row
+        self.annotation_conn = sqlite3.connect(self._read_only_uri(self.annotation_db_path), uri=True)
+        self._apply_read_pragmas(self.annotation_conn, "main")
+        # Match titles like Python's str.casefold() rather than SQLite's ASCII-only LOWER()
+        self.annotation_conn.create_function("casefold", 1, _casefold, deterministic=True)
+        # Without every column the query needs, skip highlights so the book-info branch still runs
+        self._has_annotations = _ANNOTATION_COLUMNS <= self._table_columns(self.annotation_conn, "ZAEANNOTATION")
+        if not self._has_annotations:
+            self._log("\nAnnotation database is missing the expected ZAEANNOTATION columns")
         
         if self.library_db_path and self.library_db_path.exists():
-            self.library_conn = sqlite3.connect(self.library_db_path)
-            self.library_conn.row_factory = sqlite3.Row
+            library_uri = self._read_only_uri(self.library_db_path, allow_immutable=True)
+            self.library_conn = sqlite3.connect(library_uri, uri=True)
+            self._apply_read_pragmas(self.library_conn, "main")
+
+            self._title_source = self._detect_title_source()
+            if self._title_source:
+                table, id_column = self._title_source
+                self._title_query = f"SELECT ZTITLE FROM {table} WHERE {id_column} = ?"
+                # Attach the library so book titles can be joined in the highlights query
+                self.annotation_conn.execute("ATTACH DATABASE ? AS lib", (library_uri,))
+                self._apply_read_pragmas(self.annotation_conn, "lib")
+                self._has_book_info = _BOOK_INFO_COLUMNS <= self._table_columns(self.library_conn, "ZBKLIBRARYASSET")
+
+    def _read_only_uri(self, db_path: Path, allow_immutable: bool = False) -> str:
+        """Build a SQLite URI that opens the database read-only"""
+        uri = f"{db_path.absolute().as_uri()}?mode=ro"
+        # immutable=1 skips all locking, which is only safe while nothing is writing
+        if allow_immutable and not self._has_pending_writes(db_path):
+            uri += "&immutable=1"
+        return uri
+
+    def _has_pending_writes(self, db_path: Path) -> bool:
+        """Check for a non-empty WAL or rollback journal next to the database"""
+        for suffix in ("-wal", "-journal"):
+            try:
+                if os.stat(f"{db_path}{suffix}").st_size > 0:
+                    return True
+            except OSError:
+                continue
+        return False
+
+    def _apply_read_pragmas(self, conn: sqlite3.Connection, schema: str):
+        """Tune a connection for long read-only scans"""
+        for pragma in _READ_PRAGMAS:
+            conn.execute(f"PRAGMA {schema}.{pragma}")
+
+    def _table_names(self, conn: sqlite3.Connection) -> set[str]:
+        """List the tables of a database"""
+        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        return {row[0] for row in cursor}
+
+    def _table_columns(self, conn: sqlite3.Connection, table: str) -> set[str]:
+        """List the columns of a table, empty if the table doesn't exist"""
+        return {row[1] for row in conn.execute(f"PRAGMA table_info('{table}')")}
+
+    def _detect_title_source(self) -> Optional[tuple[str, str]]:
+        """Find which known table/column layout the library database uses"""
+        tables = self._table_names(self.library_conn)
+
+        for table, id_column in _TITLE_SOURCES:
+            if table not in tables:
+                continue
+            columns = self._table_columns(self.library_conn, table)
+            if id_column in columns and "ZTITLE" in columns:
+                return table, id_column
+
+        self._log("\nNo known book title table found in library database")
+        return None
 
     def get_book_title(self, asset_id: str) -> Optional[str]:
-        """Get book title from library database using asset ID"""
-        if not self.library_conn:
+        """
+        Get book title from library database using asset ID
+
+        Highlights get their titles from the JOIN in the highlights query; this
+        lookup is for callers resolving individual asset IDs, and caches each
+        result (misses included) so repeated calls don't re-query the library.
+        """
+        if not self._title_query:
             return None
-        
+
+        if asset_id in self._title_memo:
+            return self._title_memo[asset_id]
+
+        title = None
         try:
-            # Try different possible table and column names
-            queries = [
-                "SELECT ZTITLE FROM ZBKLIBRARYASSET WHERE ZASSETID = ?",
-                "SELECT ZTITLE FROM ZBKLIBRARYASSET WHERE ZBKASSETID = ?",
-                "SELECT ZTITLE FROM ZBKLIBRARY WHERE ZASSETID = ?"
-            ]
-            
-            for query in queries:
-                try:
-                    cursor = self.library_conn.execute(query, (asset_id,))
-                    result = cursor.fetchone()
-                    if result:
-                        return result[0]
-                except sqlite3.OperationalError:
-                    continue
-                
-        except Exception as e:
+            result = self.library_conn.execute(self._title_query, (asset_id,)).fetchone()
+            if result:
+                title = result[0]
+        except sqlite3.Error as e:
             print(f"Error getting book title: {e}")
-        
-        return None
+            return None
+
+        self._title_memo[asset_id] = title
+        return title
 
     def get_highlights(self, book_title: Optional[str] = None) -> List[Highlight]:
         """
         Fetch highlights from the database, optionally filtered by book title
         
+        Args:
+            book_title: Optional book title to filter highlights
+        """
+        return list(self._iter_highlights(book_title))
+
+    def _iter_highlights(self, book_title: Optional[str] = None) -> Iterator[Highlight]:
+        """
+        Lazily yield highlights, or book information only if there are no highlights
+
         Args:
             book_title: Optional book title to filter highlights
         """
         if not self.annotation_conn:
             self.connect()
 
-        cursor = self.annotation_conn.execute("""
-            SELECT name FROM sqlite_master 
-            WHERE type='table'
-            ORDER BY name;
-        """)
-        tables = [row[0] for row in cursor]
-        print("\nAvailable tables in database:", tables)
-
-        query = """
-        SELECT 
-            ZANNOTATIONSELECTEDTEXT as text,
-            ZANNOTATIONCREATIONDATE as created_at,
-            ZANNOTATIONNOTE as note,
-            ZANNOTATIONASSETID as book_id,
-            ZANNOTATIONREPRESENTATIVETEXT as representative_text,
-            ZANNOTATIONTYPE as annotation_type,
-            ZANNOTATIONISUNDERLINE as is_underline
-        FROM ZAEANNOTATION
-        WHERE ZANNOTATIONSELECTEDTEXT IS NOT NULL
-            AND ZANNOTATIONDELETED = 0
-        ORDER BY ZANNOTATIONCREATIONDATE DESC
-        """
+        if self.verbose:
+            cursor = self.annotation_conn.execute("""
+                SELECT name FROM sqlite_master 
+                WHERE type='table'
+                ORDER BY name;
+            """)
+            tables = [row[0] for row in cursor]
+            print("\nAvailable tables in database:", tables)
 
-        try:
-            cursor = self.annotation_conn.execute(query)
-            highlights = []
-            
-            for row in cursor:
-                created_at_timestamp = row['created_at']
-                if created_at_timestamp:
-                    created_at = datetime.fromtimestamp(created_at_timestamp + 978307200)
-                else:
-                    created_at = datetime.now()
-
-                text = row['text']
-                if row['representative_text']:
-                    text = f"{text}\n\nContext: {row['representative_text']}"
-
-                note = row['note'] or ""
-                if row['annotation_type'] is not None:
-                    note_prefix = "Underline" if row['is_underline'] else "Highlight"
-                    if note:
-                        note = f"{note_prefix}\n{note}"
-                    else:
-                        note = note_prefix
-
-                current_book_title = None
-                if row['book_id']:
-                    current_book_title = self.get_book_title(row['book_id'])
-                
-                # Skip if we're filtering by book title and this isn't the right book
-                if book_title and current_book_title and book_title.lower() not in current_book_title.lower():
-                    continue
-                
-                highlight = Highlight(
-                    text=text,
-                    created_at=created_at,
-                    book_title=current_book_title or f"Book ID: {row['book_id']}" if row['book_id'] else 'Unknown Book',
-                    chapter=None,
-                    note=note
-                )
-                highlights.append(highlight)
-            
-            if highlights:
-                print(f"\nSuccessfully extracted {len(highlights)} highlights")
-                return highlights
-            elif book_title:
-                print(f"\nNo highlights found for book: {book_title}")
+        query, params = self._build_highlights_query(book_title)
+        if not query:
+            self._report_no_highlights(book_title)
+            return
+
+        highlight_count = 0
+        falling_back = False
+
+        # Query errors propagate to the caller, so a failed export is never reported as a success
+        cursor = self.annotation_conn.execute(query, params)
+
+        # Plain tuples unpack faster than sqlite3.Row name lookups
+        for (is_book_info, text, created_at, note, chapter,
+                representative_text, annotation_type, is_underline, row_book_title) in cursor:
+            if is_book_info:
+                if not falling_back:
+                    falling_back = True
+                    self._report_no_highlights(book_title)
+                    print("\nFalling back to book information only.")
             else:
-                print("\nNo highlights found")
-
-        except sqlite3.OperationalError as e:
-            print(f"\nQuery failed: {e}")
-
-        print("\nFalling back to book information only.")
-        return self._get_book_info(book_title)
-
-    def _get_book_info(self, book_title: Optional[str] = None) -> List[Highlight]:
-        """Fallback method to get only book information"""
-        query = """
-        SELECT 
-            ZTITLE as book_title,
-            ZAUTHOR as author,
-            ZREADINGPROGRESS as progress,
-            ZLASTOPENDATE as last_opened,
-            ZBOOKDESCRIPTION as description,
-            ZGENRE as genre
-        FROM ZBKLIBRARYASSET
-        WHERE ZTITLE IS NOT NULL
-        """
-        
+                highlight_count += 1
+
+            if representative_text:
+                text = f"{text}\n\nContext: {representative_text}"
+
+            if annotation_type is not None:
+                note_prefix = "Underline" if is_underline else "Highlight"
+                if note:
+                    note = f"{note_prefix}\n{note}"
+                else:
+                    note = note_prefix
+
+            yield Highlight(
+                text=text,
+                created_at=created_at,
+                book_title=row_book_title,
+                chapter=chapter,
+                note=note
+            )
+
+        if highlight_count:
+            print(f"\nSuccessfully extracted {highlight_count} highlights")
+        elif not falling_back:
+            self._report_no_highlights(book_title)
+
+    def _report_no_highlights(self, book_title: Optional[str] = None):
+        """Tell the user that nothing matched"""
         if book_title:
-            query += " AND LOWER(ZTITLE) LIKE LOWER(?)"
-            cursor = self.library_conn.execute(query, (f"%{book_title}%",))
+            print(f"\nNo highlights found for book: {book_title}")
         else:
-            query += " ORDER BY ZLASTOPENDATE DESC"
-            cursor = self.library_conn.execute(query)
-        
-        highlights = []
-        
-        for row in cursor:
-            highlight = Highlight(
-                text=f"Progress: {row['progress']*100:.1f}%" if row['progress'] is not None else "No progress data",
-                created_at=datetime.fromtimestamp(row['last_opened'] + 978307200) if row['last_opened'] else datetime.now(),
-                book_title=row['book_title'],
-                chapter=row['genre'] if row['genre'] else None,
-                note=f"Author: {row['author']}\nDescription: {row['description']}" if row['author'] or row['description'] else None
-            )
-            highlights.append(highlight)
-        
-        return highlights
+            print("\nNo highlights found")
+
+    def _build_highlights_query(self, book_title: Optional[str] = None) -> tuple[Optional[str], dict]:
+        """
+        Build a single query returning highlights, followed by a UNION ALL
+        branch of library rows that only produces results when no highlight matched
+        """
+        params = {"date_format": _DATE_FMT}
+        if book_title:
+            # Plain substring search, so '%' and '_' in the input are not wildcards
+            params["title"] = book_title.casefold()
+        branches = []
+
+        if self._has_annotations:
+            annotation_filter = """
+                ann.ZANNOTATIONSELECTEDTEXT IS NOT NULL
+                AND ann.ZANNOTATIONDELETED = 0
+            """
+
+            if self._title_source:
+                table, id_column = self._title_source
+                title_column = "a.ZTITLE"
+                title_join = f"LEFT JOIN lib.{table} a ON a.{id_column} = ann.ZANNOTATIONASSETID"
+
+                # Resolve the matching asset IDs first, so only annotations of those
+                # books are read and titles are never joined for rows that get dropped
+                if book_title:
+                    annotation_filter += f"""
+                    AND ann.ZANNOTATIONASSETID IN (
+                        SELECT {id_column} FROM lib.{table}
+                        WHERE instr(casefold(ZTITLE), :title) > 0
+                    )
+                    """
+            else:
+                title_column = "NULL"
+                title_join = ""
+
+            annotation_query = f"""
+            SELECT 
+                0 as is_book_info,
+                ann.ZANNOTATIONSELECTEDTEXT as text,
+                COALESCE(
+                    strftime(:date_format, NULLIF(ann.ZANNOTATIONCREATIONDATE, 0) + 978307200, 'unixepoch', 'localtime'),
+                    strftime(:date_format, 'now', 'localtime')
+                ) as created_at,
+                ann.ZANNOTATIONNOTE as note,
+                NULL as chapter,
+                ann.ZANNOTATIONREPRESENTATIVETEXT as representative_text,
+                ann.ZANNOTATIONTYPE as annotation_type,
+                ann.ZANNOTATIONISUNDERLINE as is_underline,
+                COALESCE(
+                    NULLIF({title_column}, ''),
+                    'Book ID: ' || NULLIF(ann.ZANNOTATIONASSETID, ''),
+                    'Unknown Book'
+                ) as book_title,
+                ann.ZANNOTATIONCREATIONDATE as sort_date
+            FROM ZAEANNOTATION ann
+            {title_join}
+            WHERE {annotation_filter}
+            """
+            branches.append(annotation_query)
+
+        if self._has_book_info:
+            book_info_query = """
+            SELECT 
+                1 as is_book_info,
+                CASE WHEN ZREADINGPROGRESS IS NOT NULL
+                    THEN printf('Progress: %.1f%%', ZREADINGPROGRESS * 100)
+                    ELSE 'No progress data'
+                END as text,
+                COALESCE(
+                    strftime(:date_format, NULLIF(ZLASTOPENDATE, 0) + 978307200, 'unixepoch', 'localtime'),
+                    strftime(:date_format, 'now', 'localtime')
+                ) as created_at,
+                CASE WHEN COALESCE(ZAUTHOR, '') != '' OR COALESCE(ZBOOKDESCRIPTION, '') != ''
+                    THEN 'Author: ' || COALESCE(ZAUTHOR, 'None') || char(10) || 'Description: ' || COALESCE(ZBOOKDESCRIPTION, 'None')
+                END as note,
+                NULLIF(ZGENRE, '') as chapter,
+                NULL as representative_text,
+                NULL as annotation_type,
+                NULL as is_underline,
+                ZTITLE as book_title,
+                ZLASTOPENDATE as sort_date
+            FROM lib.ZBKLIBRARYASSET
+            WHERE ZTITLE IS NOT NULL
+            """
+
+            # Probe the annotation table directly rather than sharing a CTE with the
+            # highlights branch, which would make SQLite materialize every highlight
+            if self._has_annotations:
+                book_info_query += f" AND NOT EXISTS (SELECT 1 FROM ZAEANNOTATION ann WHERE {annotation_filter} LIMIT 1)"
+            if book_title:
+                book_info_query += " AND instr(casefold(ZTITLE), :title) > 0"
+
+            branches.append(book_info_query)
+
+        if not branches:
+            return None, params
+
+        # Highlights are grouped by book for export, titles compared case-insensitively
+        # with the exact title as a tie-breaker so each book stays contiguous; book
+        # information is ordered by last opened. Grouping needs a full sort, so rows
+        # only start arriving once SQLite has read every match.
+        query = f"""
+        SELECT is_book_info, text, created_at, note, chapter,
+            representative_text, annotation_type, is_underline, book_title
+        FROM ({" UNION ALL ".join(branches)})
+        ORDER BY
+            CASE WHEN is_book_info THEN NULL ELSE casefold(book_title) END,
+            CASE WHEN is_book_info THEN NULL ELSE book_title END,
+            sort_date DESC
+        """
+        return query, params
 
     def export_to_markdown(self, output_path: Path, book_title: Optional[str] = None):
         """
@@ -237,24 +503,50 @@ class BookHighlightExtractor:
             output_path: Path to save the markdown file
             book_title: Optional book title to filter highlights
         """
-        highlights = self.get_highlights(book_title)
+        # Connect up front so a missing database doesn't leave an empty file behind
+        if not self.annotation_conn:
+            self.connect()
         
-        with open(output_path, 'w', encoding='utf-8') as f:
+        with open(output_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
             current_book = None
+            buf = []
             
-            for highlight in highlights:
+            for highlight in self._iter_highlights(book_title):
                 if highlight.book_title != current_book:
+                    # Flush once per book rather than once per line
+                    f.writelines(buf)
+                    buf.clear()
                     current_book = highlight.book_title
-                    f.write(f"\n## {current_book}\n\n")
+                    buf.append(f"\n## {current_book}\n\n")
                 
-                f.write(f"> {highlight.text}\n")
+                buf.append(f"> {highlight.text}\n")
                 if highlight.note:
-                    f.write(f"\nNote: {highlight.note}\n")
-                f.write(f"\n- Chapter: {highlight.chapter or 'N/A'}\n")
-                f.write(f"- Date: {highlight.created_at.strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+                    buf.append(f"\nNote: {highlight.note}\n")
+                buf.append(f"\n- Chapter: {highlight.chapter or 'N/A'}\n")
+                buf.append(f"- Date: {highlight.created_at}\n\n")
+                
+                # Keep memory bounded for books with very many highlights
+                if len(buf) >= _MAX_BUFFERED_LINES:
+                    f.writelines(buf)
+                    buf.clear()
+            
+            f.writelines(buf)
 
 def main():
-    extractor = BookHighlightExtractor()
+    parser = argparse.ArgumentParser(description="Export Apple Books highlights to Markdown")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print system information and database discovery details")
+    args = parser.parse_args()
+    
+    extractor = BookHighlightExtractor(verbose=args.verbose)
+    
+    if args.verbose:
+        print("\nSystem Information:")
+        print(f"Home directory: {Path.home()}")
+        print(f"Library exists: {(Path.home() / 'Library').exists()}")
+        print(f"Books container exists: {(Path.home() / 'Library/Containers/com.apple.Books').exists()}")
+        print(f"\nSelected database path: {extractor.annotation_db_path}")
+        print(f"Database exists: {extractor.annotation_db_path.exists()}\n")
     
     try:
         # Get user input for book title
@@ -263,7 +555,7 @@ def main():
         
         # Create output filename based on input
         if book_title:
-            safe_title = "".join(c for c in book_title if c.isalnum() or c in (' ', '-', '_'))
+            safe_title = book_title.translate(_FILENAME_TABLE)
             output_path = Path.home() / "Desktop" / f"book_highlights_{safe_title}.md"
         else:
             output_path = Path.home() / "Desktop" / "book_highlights_all.md"
@@ -280,11 +572,4 @@ def main():
         print(f"Unexpected error: {e}")
 
 if __name__ == "__main__":
-    extractor = BookHighlightExtractor()
-    print("\nSystem Information:")
-    print(f"Home directory: {Path.home()}")
-    print(f"Library exists: {(Path.home() / 'Library').exists()}")
-    print(f"Books container exists: {(Path.home() / 'Library/Containers/com.apple.Books').exists()}")
-    print(f"\nSelected database path: {extractor.annotation_db_path}")
-    print(f"Database exists: {extractor.annotation_db_path.exists()}\n")
     main() 
\ No newline at end of file